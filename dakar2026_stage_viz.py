@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Dakar Rally Live Timing Server v8
-- Uses actual class IDs from API data (team.clazz) for filtering
+- Uses actual class IDs from API data (team.clazz) for filtering, resolved server-side
 - Class-relative position calculations based on real class membership
 - Simplified sorting (always P1 to last)
 - 15 second countdown timer
@@ -10,18 +10,67 @@ Dakar Rally Live Timing Server v8
 Usage:
     pip install flask requests
     python dakar_server.py
+    python dakar_server.py export --category all --stages 0-13 -o results.csv
     
 Then open http://localhost:5000 in your browser
 """
 
-from flask import Flask, jsonify, request, render_template_string
-import requests
+from flask import Flask, Response, jsonify, request, render_template_string, stream_with_context
 from datetime import datetime
+from array import array
+import argparse
+import atexit
+import csv
+import gzip
+import html
+import io
+from collections import OrderedDict, deque
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import signal
+import statistics
+import sys
+import threading
+import time
 
 app = Flask(__name__)
 
 API_BASE = "https://www.dakar.live.worldrallyraidchampionship.com/api"
 
+# Memory budget for cached upstream documents and everything computed from them
+CACHE_MAX_MB = float(os.environ.get('DAKAR_CACHE_MAX_MB', '256'))
+# How long a fetched document is served before asking upstream again
+DOC_TTL_SECONDS = float(os.environ.get('DAKAR_DOC_TTL', '10'))
+# Optional file the position history is persisted to, and how often
+HISTORY_PATH = os.environ.get('DAKAR_HISTORY_PATH')
+HISTORY_SAVE_SECONDS = float(os.environ.get('DAKAR_HISTORY_SAVE_SECONDS', '60'))
+# Event feed: ring buffer size and alert thresholds
+EVENTS_MAX = int(os.environ.get('DAKAR_EVENTS_MAX', '5000'))
+EVENT_TIME_LOSS_MINUTES = float(os.environ.get('DAKAR_EVENT_TIME_LOSS_MINUTES', '10'))
+EVENT_STALL_MINUTES = float(os.environ.get('DAKAR_EVENT_STALL_MINUTES', '30'))
+# Global budget and queueing for upstream calls; live stage before recent stages before history
+UPSTREAM_RPS = float(os.environ.get('DAKAR_UPSTREAM_RPS', '5'))
+UPSTREAM_WORKERS = int(os.environ.get('DAKAR_UPSTREAM_WORKERS', '4'))
+UPSTREAM_QUEUE_MAX = int(os.environ.get('DAKAR_UPSTREAM_QUEUE_MAX', '50'))
+UPSTREAM_WAIT_SECONDS = float(os.environ.get('DAKAR_UPSTREAM_WAIT_SECONDS', '20'))
+LIVE_YEAR = os.environ.get('DAKAR_LIVE_YEAR', '2026')
+RECENT_STAGES = int(os.environ.get('DAKAR_RECENT_STAGES', '2'))
+# Warm-start file with the latest documents, restored (as stale) on boot; empty to disable
+SNAPSHOT_PATH = os.environ.get('DAKAR_SNAPSHOT_PATH', 'dakar2026_snapshot.json')
+SNAPSHOT_SAVE_SECONDS = float(os.environ.get('DAKAR_SNAPSHOT_SAVE_SECONDS', '60'))
+SNAPSHOT_MAX_DOCUMENTS = int(os.environ.get('DAKAR_SNAPSHOT_MAX_DOCUMENTS', '20'))
+# Largest upstream document accepted, and the read size while streaming it
+MAX_PAYLOAD_MB = float(os.environ.get('DAKAR_MAX_PAYLOAD_MB', '64'))
+PARSE_CHUNK_BYTES = 64 * 1024
+# Categories on the video wall, and how many entries per class it shows by default
+WALL_CATEGORIES = os.environ.get('DAKAR_WALL_CATEGORIES', 'M,A,T,K,F').split(',')
+WALL_TOP = int(os.environ.get('DAKAR_WALL_TOP', '10'))
+# Upstream documents fetched in parallel by an export
+EXPORT_WORKERS = int(os.environ.get('DAKAR_EXPORT_WORKERS', '4'))
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -173,58 +222,12 @@ HTML_TEMPLATE = """
         let processedData = [];
         let sortColumn = 'classStagePos';
         let stageComparisonWp = null;
+        let projections = {};
+        // Static team data per API category, from /api/teams (driver, photo, class resolved server-side)
+        let teamRegistries = {};
+        let projectionsKey = null;
         
-        const FLAGS = {
-            fra: '🇫🇷', esp: '🇪🇸', ger: '🇩🇪', GER: '🇩🇪', aus: '🇦🇺', arg: '🇦🇷',
-            qat: '🇶🇦', ksa: '🇸🇦', KSA: '🇸🇦', bel: '🇧🇪', por: '🇵🇹', POR: '🇵🇹', ned: '🇳🇱', NED: '🇳🇱',
-            cze: '🇨🇿', pol: '🇵🇱', bra: '🇧🇷', jpn: '🇯🇵', chn: '🇨🇳',
-            rsa: '🇿🇦', RSA: '🇿🇦', aut: '🇦🇹', chi: '🇨🇱', CHI: '🇨🇱', ltu: '🇱🇹', nzl: '🇳🇿',
-            usa: '🇺🇸', gbr: '🇬🇧', ita: '🇮🇹', mex: '🇲🇽', lux: '🇱🇺',
-            ecu: '🇪🇨', kaz: '🇰🇿', ang: '🇦🇴', ANG: '🇦🇴', moz: '🇲🇿', rou: '🇷🇴',
-            sui: '🇨🇭', SUI: '🇨🇭', svk: '🇸🇰', svn: '🇸🇮', ukr: '🇺🇦', ind: '🇮🇳',
-            sau: '🇸🇦', SAU: '🇸🇦', uae: '🇦🇪', UAE: '🇦🇪', bhr: '🇧🇭', kwt: '🇰🇼',
-            col: '🇨🇴', per: '🇵🇪', ury: '🇺🇾', crc: '🇨🇷', rus: '🇷🇺',
-        };
-        
-        // Map actual class IDs from API to class names
-        // These are the real class IDs from team.clazz field
-        const CLASS_ID_MAP = {
-            // Cars (A) - Ultimate/T1+
-            'e18df6479eeb221edf506539ca01a0fb': 'ultimate',
-            'cd3a224fa3f90b3d44ad779de5a61de0': 'ultimate',
-            '56b1895a94e9bde92261fefdccfd9300': 'ultimate',
-            '8ec12cac9b3eb552e37a6f52f3eb874c': 'ultimate',
-            // Cars (A) - T3 Lightweight
-            '75ca283e010c2d8f55515206c945cc5b': 't3',
-            // Cars (A) - SSV
-            '21a677c34d3929cb01e5e7163a1dda0c': 'ssv',
-            'fa9bd58337b8e5a6c01aea95af09dda7': 'ssv',
-            // Cars (A) - Stock/T2
-            'f92c26257b0bc1bf01d1ed3406a2798e': 'stock',
-            '25ab9f4ea3d9f41969b2b47f627168aa': 'stock',
-            // Cars (A) - Trucks
-            '596e4eb3814731d718603e5313878fd2': 'trucks',
-            '0aca7403b23b1d4308e5e124290e09bc': 'trucks',
-            // Bikes (M) - RallyGP (top factory riders)
-            'bb94ac9163db104dfb3b5f878235edb9': 'rallygp',
-            // Bikes (M) - Rally2 (larger field)
-            '978032dc39dd0c9245c7bc4097a72ac0': 'rally2',
-        };
-
-        // Track unknown class IDs for debugging
-        const unknownClassIds = new Set();
-        
-        // Get the class name from class ID
-        function getClassName(clazzId) {
-            if (!clazzId) return 'unknown';
-            if (CLASS_ID_MAP[clazzId]) return CLASS_ID_MAP[clazzId];
-            // Log unknown class IDs to console for debugging
-            if (!unknownClassIds.has(clazzId)) {
-                unknownClassIds.add(clazzId);
-                console.log('Unknown class ID:', clazzId, '- add to CLASS_ID_MAP');
-            }
-            return 'unknown';
-        }
+        const FLAGS = {{ flags|tojson }};
         
         const CLASS_CONFIG = {
             'A': {
@@ -302,18 +305,6 @@ HTML_TEMPLATE = """
             return prefix + formatTime(Math.abs(ms));
         }
 
-        function getDriverName(competitors) {
-            if (!competitors || !competitors.length) return 'Unknown';
-            const driver = competitors.find(c => c.role === 'P') || competitors[0];
-            return driver.name || `${driver.firstName} ${driver.lastName}`;
-        }
-        
-        function getDriverPhoto(competitors) {
-            if (!competitors || !competitors.length) return null;
-            const driver = competitors.find(c => c.role === 'P') || competitors[0];
-            return driver.profil_sm || driver.profil || null;
-        }
-
         function updateCountdown() {
             countdown--;
             if (countdown <= 0) {
@@ -374,6 +365,7 @@ HTML_TEMPLATE = """
             if (rawData.length > 0) {
                 processedData = processData(rawData);
                 sortAndRender();
+                fetchProjections();
             }
         }
         
@@ -452,18 +444,16 @@ HTML_TEMPLATE = """
             });
             allWaypoints = Array.from(wpSet).sort();
             
+            const teams = teamRegistries[CLASS_CONFIG[currentCategory]?.apiCategory || currentCategory]?.teams || {};
+
             // First pass: extract raw data
             let entries = data.map(entry => {
-                const team = entry.team || {};
+                const team = teams[entry.bib] || {};
                 const dss = entry.dss || {};
                 const cg = entry.cg || {};
                 const cs = entry.cs || {};
                 const ce = entry.ce || {};
                 
-                // Get the actual class name from the class ID
-                const clazzId = team.clazz;
-                const clazzName = getClassName(clazzId);
-                
                 const waypointData = {};
                 allWaypoints.forEach(wp => {
                     if (cs[wp] || cg[wp]) {
@@ -483,17 +473,17 @@ HTML_TEMPLATE = """
                 const latestOverallData = latestCgWp ? cg[latestCgWp] : null;
                 
                 return {
-                    bib: team.bib,
+                    bib: entry.bib,
                     brand: team.brand,
                     model: team.model,
                     vehicle: team.vehicle,
-                    clazzId: clazzId,
-                    clazzName: clazzName,  // Use actual class from API
-                    driver: getDriverName(team.competitors),
-                    driverPhoto: getDriverPhoto(team.competitors),
-                    nationality: team.competitors?.[0]?.nationality,
-                    isW2RC: team.is?.w2rc,
-                    isOBM: team.is?.obm,  // Original by Motul flag
+                    clazzId: team.clazzId,
+                    clazzName: team.clazzName || 'unknown',  // Resolved from team.clazz by the server
+                    driver: team.driver || 'Unknown',
+                    driverPhoto: team.driverPhoto,
+                    nationality: team.nationality,
+                    isW2RC: team.isW2RC,
+                    isOBM: team.isOBM,  // Original by Motul flag
                     startPos: dss.position,
                     hasStarted: dss.real,
                     waypointData: waypointData,
@@ -774,7 +764,7 @@ HTML_TEMPLATE = """
                                     <div class="font-bold text-green-700">P${e.classOverallPos}</div>
                                     <div class="font-mono text-green-800 text-sm">${formatTime(stageComparisonWp ? e.waypointData[stageComparisonWp]?.overallTime : null)}</div>
                                     <div class="text-xs text-red-600 font-semibold">${formatGap(e.classOverallGap)}</div>
-                                ` : '<span class="text-gray-400">—</span>'}
+                                ` : projectionHtml(e)}
                             </td>
                         </tr>
                     `;
@@ -787,6 +777,39 @@ HTML_TEMPLATE = """
             document.getElementById('content').classList.add('fade-in');
         }
 
+        // Projected finish for competitors still on stage (no position at the comparison waypoint yet)
+        function projectionKey() {
+            const cls = CLASS_CONFIG[currentCategory]?.forceClass || currentClass;
+            return `${currentCategory}-${document.getElementById('stage').value}-${cls}`;
+        }
+
+        function projectionHtml(e) {
+            const p = projectionsKey === projectionKey() ? projections[e.bib] : null;
+            if (!e.hasStarted || !p || !p.projectedPos) return '<span class="text-gray-400">—</span>';
+            return `
+                <div class="font-bold text-gray-500" title="Projected class position at ${p.finishWp}">~P${p.projectedPos}</div>
+                <div class="font-mono text-gray-500 text-xs">~${formatTime(p.finishTime)}</div>
+                ${p.nextWaypoint ? `<div class="text-xs text-gray-400">WP${p.nextWaypoint.slice(2)} ~${formatTime(p.nextTime)}</div>` : ''}
+            `;
+        }
+
+        async function fetchProjections() {
+            if (CLASS_CONFIG[currentCategory]?.usesCeRanking) return;
+            const stage = document.getElementById('stage').value;
+            const cls = CLASS_CONFIG[currentCategory]?.forceClass || currentClass;
+            try {
+                const response = await fetch(`/api/projections?year=2026&category=${currentCategory}&stage=${stage}&class=${cls}`);
+                const data = await response.json();
+                if (data.error) return;
+                projections = {};
+                projectionsKey = `${currentCategory}-${stage}-${cls}`;
+                data.entries.forEach(p => { projections[p.bib] = { ...p, finishWp: data.finish }; });
+                sortAndRender();
+            } catch (err) {
+                console.log('Projections unavailable:', err.message);
+            }
+        }
+
         async function fetchData() {
             const stage = document.getElementById('stage').value;
             // Use apiCategory if defined (e.g., Trucks uses Cars API)
@@ -796,13 +819,15 @@ HTML_TEMPLATE = """
             document.getElementById('refresh-icon').innerHTML = '<div class="loader" style="width:16px;height:16px;border-width:2px;"></div>';
 
             try {
-                const response = await fetch(`/api/lastScore?year=2026&category=${apiCategory}&stage=${stage}`);
-                const data = await response.json();
-                
-                if (data.error) {
+                const response = await fetch(`/api/timing?year=2026&category=${apiCategory}&stage=${stage}`);
+                const stale = response.headers.get('X-Data-Stale') === '1';
+                const timing = await response.json();
+                const data = timing.entries;
+
+                if (timing.error) {
                     document.getElementById('content').innerHTML = `
                         <div class="p-12 text-center">
-                            <p class="text-red-500 font-semibold">Error: ${data.error}</p>
+                            <p class="text-red-500 font-semibold">Error: ${timing.error}</p>
                             <button onclick="fetchData()" class="mt-4 bg-red-600 text-white px-4 py-2 rounded hover:bg-red-700">Retry</button>
                         </div>
                     `;
@@ -831,9 +856,18 @@ HTML_TEMPLATE = """
                     return;
                 }
                 
+                // Team data only changes when new bibs appear; the versioned URL is cached by the browser
+                if (teamRegistries[apiCategory]?.version !== timing.teamsVersion) {
+                    const teamsResponse = await fetch(`/api/teams?year=2026&category=${apiCategory}&v=${timing.teamsVersion}`);
+                    teamRegistries[apiCategory] = await teamsResponse.json();
+                }
+
                 processedData = processData(data);
                 sortAndRender();
-                document.getElementById('lastUpdate').textContent = 'Updated: ' + new Date().toLocaleTimeString();
+                fetchProjections();
+                document.getElementById('lastUpdate').textContent = stale
+                    ? 'Saved data, refreshing...'
+                    : 'Updated: ' + new Date().toLocaleTimeString();
                 
             } catch (err) {
                 document.getElementById('content').innerHTML = `
@@ -858,10 +892,1919 @@ HTML_TEMPLATE = """
 </html>
 """
 
+THIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Dakar Rally 2026 - Live Timing</title>
+    <style>
+        body { margin: 0; font-family: sans-serif; background: #f3f4f6; color: #111827; }
+        header { background: #b91c1c; color: white; padding: 6px 12px; display: flex; justify-content: space-between; }
+        .stats { display: flex; gap: 24px; padding: 8px 12px; background: white; font-size: 14px; }
+        .empty { padding: 48px; text-align: center; color: #6b7280; }
+        .standings { width: 100%; border-collapse: collapse; background: white; font-size: 14px; }
+        .standings th { background: #1f2937; color: white; padding: 6px; border-left: 1px solid #4b5563; }
+        .standings th.active { text-decoration: underline; }
+        .standings td { padding: 4px 6px; text-align: center; border-left: 1px solid #e5e7eb; border-bottom: 1px solid #e5e7eb; }
+        .standings small { display: block; font-size: 11px; color: #4b5563; }
+        .standings .driver { text-align: left; white-space: nowrap; }
+        .standings .bib { background: #1f2937; color: white; padding: 0 4px; border-radius: 3px; font-family: monospace; }
+        .standings .gap { color: #dc2626; }
+        .standings .top { color: #d97706; }
+        .standings .none { color: #d1d5db; }
+        .standings .pos { background: #f0fdf4; color: #15803d; }
+        .row.odd { background: #f9fafb; }
+        .row.w2rc { background: #fffbeb; }
+        .p1 { background: #fcd34d; } .p2 { background: #d1d5db; } .p3 { background: #fb923c; }
+    </style>
+</head>
+<body>
+    <header><b>🏆 Dakar 2026</b><span id="lastUpdate"></span></header>
+    <div id="content"><p class="empty">Loading live timing data...</p></div>
+
+    <script>
+        // /thin?category=A&class=ultimate&stage=3&sort=classStagePos - the server renders the table,
+        // this page only swaps it in when the data version (ETag) changes
+        const params = new URLSearchParams(location.search);
+        let etag = null;
+
+        async function refresh() {
+            try {
+                const response = await fetch('/api/fragment?' + params.toString(), { cache: 'no-cache' });
+                const version = response.headers.get('ETag');
+                if (version !== etag) {
+                    document.getElementById('content').innerHTML = await response.text();
+                    etag = version;
+                }
+                document.getElementById('lastUpdate').textContent = new Date().toLocaleTimeString();
+            } catch (err) {
+                document.getElementById('lastUpdate').textContent = 'Update failed';
+            }
+        }
+
+        refresh();
+        setInterval(refresh, 15000);
+    </script>
+</body>
+</html>
+"""
+
+WALL_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Dakar Rally 2026 - Video Wall</title>
+    <script src="https://cdn.tailwindcss.com"></script>
+</head>
+<body class="bg-gray-900 text-white min-h-screen">
+    <div class="bg-gradient-to-r from-red-600 to-red-800 px-3 py-2 flex items-center justify-between">
+        <h1 class="text-lg font-bold">🏆 Dakar 2026 <span id="stage-label"></span></h1>
+        <div class="text-xs" id="lastUpdate"></div>
+    </div>
+    <div id="wall" class="grid gap-2 p-2" style="grid-template-columns: repeat(auto-fit, minmax(260px, 1fr));"></div>
+
+    <script>
+        // /wall?stage=3&top=10 - one /api/wall request covers every category
+        const params = new URLSearchParams(location.search);
+        const stage = params.get('stage') || '8';
+        const top = params.get('top') || '';
+
+        const CATEGORY_NAMES = { M: '🏍️ Bikes', A: '🚗 Cars', T: '🚛 Trucks', K: '🏛️ Classic', F: '🔋 Mission 1000' };
+        const CLASS_NAMES = {
+            all: 'All', ultimate: 'Ultimate', t3: 'T3 Lightweight', ssv: 'SSV', stock: 'Stock', trucks: 'Trucks',
+            rallygp: 'RallyGP', rally2: 'Rally2', original: 'Original by Motul',
+        };
+
+        function formatTime(ms) {
+            if (!ms) return '';
+            const secs = Math.floor(ms / 1000);
+            const h = Math.floor(secs / 3600);
+            const m = Math.floor((secs % 3600) / 60);
+            const s = secs % 60;
+            if (h > 0) return `${h}:${m.toString().padStart(2,'0')}:${s.toString().padStart(2,'0')}`;
+            return `${m}:${s.toString().padStart(2,'0')}`;
+        }
+
+        function renderWall(data) {
+            document.getElementById('stage-label').textContent = stage === '0' ? 'Prologue' : `Stage ${stage}`;
+            document.getElementById('wall').innerHTML = data.categories.map(cat => {
+                if (cat.error) {
+                    return `<div class="bg-gray-800 rounded p-2"><h2 class="font-bold">${CATEGORY_NAMES[cat.category] || cat.category}</h2>
+                        <p class="text-red-400 text-sm">${cat.error}</p></div>`;
+                }
+                const classes = cat.classes.filter(cls => cls.entries.length).map(cls => `
+                    <div class="mt-2">
+                        <div class="text-xs text-amber-400 font-semibold">${CLASS_NAMES[cls.class] || cls.class}
+                            ${cls.waypoint ? `<span class="text-gray-400">@WP${cls.waypoint.slice(2)}</span>` : ''}</div>
+                        <table class="w-full text-sm">${cls.entries.map(e => `
+                            <tr class="border-b border-gray-700">
+                                <td class="w-8 font-bold">P${e.stagePos}</td>
+                                <td class="w-10 font-mono text-xs text-gray-400">${e.bib}</td>
+                                <td class="truncate max-w-0 w-full">${e.driver || ''}</td>
+                                <td class="font-mono text-xs text-right whitespace-nowrap">${e.stageGap ? '+' + formatTime(e.stageGap) : formatTime(e.stageTime)}</td>
+                            </tr>`).join('')}
+                        </table>
+                    </div>`).join('');
+                return `<div class="bg-gray-800 rounded p-2">
+                    <h2 class="font-bold">${CATEGORY_NAMES[cat.category] || cat.category}${cat.stale ? ' <span class="text-xs text-gray-400">(saved)</span>' : ''}</h2>
+                    ${classes || '<p class="text-gray-500 text-sm mt-2">No data available</p>'}
+                </div>`;
+            }).join('');
+        }
+
+        async function fetchWall() {
+            try {
+                const response = await fetch(`/api/wall?year=2026&stage=${stage}${top ? '&top=' + top : ''}`);
+                renderWall(await response.json());
+                document.getElementById('lastUpdate').textContent = 'Updated: ' + new Date().toLocaleTimeString();
+            } catch (err) {
+                document.getElementById('lastUpdate').textContent = 'Update failed: ' + err.message;
+            }
+        }
+
+        fetchWall();
+        setInterval(fetchWall, 15000);
+    </script>
+</body>
+</html>
+"""
+
+
+class UpstreamError(Exception):
+    pass
+
+
+def approx_size(obj):
+    # Rough deep size of JSON-like data in bytes, used for the cache memory budget
+    size = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return size
+
+
+class Snapshot:
+    # One upstream document plus everything derived from it, namespaced by (year, category, stage)
+    def __init__(self, key, doc, version, parse=None):
+        self.key = key
+        self.doc = doc
+        self.version = version
+        self.parse = parse or {}
+        self.stale = False
+        self.fetched_at = time.time()
+        self.derived = {}
+        self.size = approx_size(doc)
+
+
+class SnapshotCache:
+    # LRU of snapshots bounded by an approximate memory budget rather than an entry count
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._snapshots = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            snap = self._snapshots.get(key)
+            if snap is None:
+                self.misses += 1
+                return None
+            self._snapshots.move_to_end(key)
+            self.hits += 1
+            return snap
+
+    def put(self, key, doc, version, parse=None):
+        snap = Snapshot(key, doc, version, parse)
+        with self._lock:
+            old = self._snapshots.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            self._snapshots[key] = snap
+            self.bytes += snap.size
+            self._evict()
+        return snap
+
+    def put_if_changed(self, key, doc, version, parse=None):
+        # Like put, but keeps the cached snapshot when it already has this version.
+        # Returns (snapshot, previous snapshot or None, whether it was stored).
+        with self._lock:
+            current = self._snapshots.get(key)
+            if current is not None and current.version == version:
+                current.fetched_at = time.time()
+                current.stale = False
+                return current, current, False
+            return self.put(key, doc, version, parse), current, True
+
+    def memo(self, snap, name, compute):
+        # Compute a value once per document version; its size counts against the budget
+        with self._lock:
+            if name in snap.derived:
+                return snap.derived[name]
+        value = compute()
+        size = approx_size(value)
+        with self._lock:
+            if name in snap.derived:
+                return snap.derived[name]
+            snap.derived[name] = value
+            snap.size += size
+            if self._snapshots.get(snap.key) is snap:
+                self.bytes += size
+                self._evict()
+        return value
+
+    def recent(self, limit):
+        # Most recently used first
+        with self._lock:
+            return list(reversed(self._snapshots.values()))[:limit]
+
+    def _evict(self):
+        # Never evict the most recently used snapshot, even if it alone exceeds the budget
+        while self.bytes > self.max_bytes and len(self._snapshots) > 1:
+            _, snap = self._snapshots.popitem(last=False)
+            self.bytes -= snap.size
+            self.evictions += 1
+            self.evicted_bytes += snap.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'maxBytes': self.max_bytes,
+                'bytes': self.bytes,
+                'entries': len(self._snapshots),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evictedBytes': self.evicted_bytes,
+                'namespaces': [
+                    {
+                        'year': key[0],
+                        'category': key[1],
+                        'stage': key[2],
+                        'version': snap.version,
+                        'bytes': snap.size,
+                        'derived': len(snap.derived),
+                        'parse': snap.parse,
+                        'age': round(time.time() - snap.fetched_at, 1),
+                        'stale': snap.stale,
+                    }
+                    for key, snap in reversed(self._snapshots.items())
+                ],
+            }
+
+
+cache = SnapshotCache(CACHE_MAX_MB)
+
+
+class PayloadReader:
+    # File-like view of a streamed response body that hashes, counts and caps bytes as they arrive
+    def __init__(self, response, limit):
+        self._chunks = response.iter_content(PARSE_CHUNK_BYTES)
+        self._limit = limit
+        self._hash = hashlib.sha1()
+        self.bytes = 0
+        self.buffer = 0  # largest raw body buffer held at once
+
+    def read(self, size=-1):
+        # Returns one chunk whatever the requested size; b'' at the end
+        if size == 0:
+            return b''
+        chunk = next(self._chunks, b'')
+        self.bytes += len(chunk)
+        if self.bytes > self._limit:
+            raise UpstreamError(f"upstream document exceeds {MAX_PAYLOAD_MB:g} MB")
+        self._hash.update(chunk)
+        self.buffer = max(self.buffer, len(chunk))
+        return chunk
+
+    def read_all(self):
+        body = b''.join(iter(self.read, b''))
+        self.buffer = len(body)
+        return body
+
+    def version(self):
+        return self._hash.hexdigest()[:16]
+
+
+_ijson = None
+
+
+def load_ijson():
+    # Optional: without ijson documents are read whole and pruned afterwards
+    global _ijson
+    if _ijson is None:
+        try:
+            import ijson
+            _ijson = ijson
+        except ImportError:
+            _ijson = False
+    return _ijson or None
+
+
+def prune_timing(timing):
+    if not isinstance(timing, dict):
+        return timing
+    return {wp: {'absolute': value.get('absolute')} if isinstance(value, dict) else value
+            for wp, value in timing.items()}
+
+
+def prune_entry(entry):
+    # Keep only the fields the page and the endpoints above read
+    if not isinstance(entry, dict):
+        return entry
+    team = entry.get('team') or {}
+    dss = entry.get('dss') or {}
+    ce = entry.get('ce') or {}
+    flags = team.get('is') or {}
+    return {
+        'team': {
+            'bib': team.get('bib'),
+            'brand': team.get('brand'),
+            'model': team.get('model'),
+            'vehicle': team.get('vehicle'),
+            'clazz': team.get('clazz'),
+            'is': {'w2rc': flags.get('w2rc'), 'obm': flags.get('obm')},
+            'competitors': [
+                {k: c[k] for k in ('role', 'name', 'firstName', 'lastName', 'profil_sm', 'profil', 'nationality')
+                 if k in c}
+                for c in team.get('competitors') or [] if isinstance(c, dict)
+            ],
+        },
+        'dss': {'position': dss.get('position'), 'real': dss.get('real')},
+        'cs': prune_timing(entry.get('cs') or {}),
+        'cg': prune_timing(entry.get('cg') or {}),
+        'ce': {k: ce[k] for k in ('position', 'absolute', 'relative') if k in ce},
+    }
+
+
+def parse_payload(reader, prune=None):
+    # With prune, top-level array items are parsed and pruned one at a time as bytes arrive
+    ijson = load_ijson() if prune else None
+    if ijson is not None:
+        try:
+            return [prune(item) for item in ijson.items(reader, 'item', use_float=True)], 'ijson'
+        except ijson.JSONError:
+            # API returned non-JSON response (likely empty or error page)
+            return [], 'ijson'
+
+    body = reader.read_all()
+
+    # Handle empty response (stage not yet available)
+    if not body.strip():
+        return [], 'json'
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return [], 'json'
+
+    # Handle various empty data formats
+    if data is None:
+        return [], 'json'
+
+    if prune and isinstance(data, list):
+        data = [prune(item) for item in data]
+    return data, 'json'
+
+
+def download(path, prune=None):
+    # Returns (data, version, parse stats); version is a content hash so derived data can be keyed by it.
+    # Only the scheduler calls this; everything else goes through fetch_upstream.
+    import requests  # deferred to keep startup fast
+
+    url = f"{API_BASE}/{path}"
+    limit = int(MAX_PAYLOAD_MB * 1024 * 1024)
+
+    try:
+        response = requests.get(url, timeout=15, stream=True)
+    except requests.exceptions.RequestException as e:
+        raise UpstreamError(str(e)) from e
+
+    try:
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length') or 0) > limit:
+            raise UpstreamError(f"upstream document exceeds {MAX_PAYLOAD_MB:g} MB")
+        reader = PayloadReader(response, limit)
+        started = time.perf_counter()
+        data, parser = parse_payload(reader, prune)
+    except requests.exceptions.RequestException as e:
+        raise UpstreamError(str(e)) from e
+    finally:
+        response.close()
+
+    parse = {
+        'parser': parser,
+        'bytes': reader.bytes,
+        'bufferBytes': reader.buffer,
+        'parseMs': round((time.perf_counter() - started) * 1000, 1),
+    }
+    return data, reader.version(), parse
+
+
+PRIORITY_LIVE, PRIORITY_RECENT, PRIORITY_HISTORY = 0, 1, 2
+PRIORITY_NAMES = ['live', 'recent', 'history']
+
+
+class _Ticket:
+    # One queued upstream fetch, shared by every request waiting for the same path
+    def __init__(self, path, prune, priority):
+        self.path = path
+        self.prune = prune
+        self.priority = priority
+        self.waiters = 1
+        self.started = False
+        self.cancelled = False
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class UpstreamScheduler:
+    # All calls to API_BASE go through here: priority queues, a global requests-per-second
+    # token bucket, bounded queue lengths and cancellation once nobody waits for a fetch
+    def __init__(self, rate, workers, queue_max):
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.workers = workers
+        self.queue_max = queue_max
+        self.live_stage = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._pending = {}
+        self._queued = [0] * len(PRIORITY_NAMES)
+        self._cond = threading.Condition()
+        self._tokens = self.burst
+        self._token_time = time.monotonic()
+        self._threads = []
+        self.in_flight = 0
+        self.completed = [0] * len(PRIORITY_NAMES)
+        self.cancelled = [0] * len(PRIORITY_NAMES)
+        self.rejected = [0] * len(PRIORITY_NAMES)
+        self.shared = [0] * len(PRIORITY_NAMES)
+        self._waits = [deque(maxlen=500) for _ in PRIORITY_NAMES]
+
+    def fetch(self, path, prune=None, priority=PRIORITY_LIVE, timeout=UPSTREAM_WAIT_SECONDS):
+        ticket = self._submit(path, prune, priority)
+        if not ticket.done.wait(timeout):
+            self._leave(ticket)
+            raise UpstreamError(f"timed out waiting for upstream ({PRIORITY_NAMES[priority]} queue)")
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket.result
+
+    def note_stage(self, year, stage):
+        # The highest stage of the live year with data is treated as the live stage
+        if year == LIVE_YEAR and stage.isdigit():
+            with self._cond:
+                self.live_stage = max(self.live_stage or 0, int(stage))
+
+    def priority(self, key):
+        year, category, stage = key
+        if year != LIVE_YEAR:
+            return PRIORITY_HISTORY
+        if category == 'category' or not str(stage).isdigit():
+            return PRIORITY_RECENT
+        if self.live_stage is None or int(stage) >= self.live_stage:
+            return PRIORITY_LIVE
+        if self.live_stage - int(stage) <= RECENT_STAGES:
+            return PRIORITY_RECENT
+        return PRIORITY_HISTORY
+
+    def _submit(self, path, prune, priority):
+        with self._cond:
+            if not self._threads:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self._work, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+            ticket = self._pending.get(path)
+            if ticket is not None:
+                # Same document already queued or in flight: wait for that one
+                ticket.waiters += 1
+                self.shared[priority] += 1
+                # Moved up to the more urgent queue only if that queue has room; otherwise it keeps its place
+                if (priority < ticket.priority and not ticket.started
+                        and self._queued[priority] < self.queue_max):
+                    self._queued[ticket.priority] -= 1
+                    self._queued[priority] += 1
+                    ticket.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._seq), ticket))
+                return ticket
+
+            if self._queued[priority] >= self.queue_max:
+                self.rejected[priority] += 1
+                raise UpstreamError(f"upstream {PRIORITY_NAMES[priority]} queue is full, try again shortly")
+
+            ticket = _Ticket(path, prune, priority)
+            self._pending[path] = ticket
+            self._queued[priority] += 1
+            heapq.heappush(self._heap, (priority, next(self._seq), ticket))
+            self._cond.notify()
+            return ticket
+
+    def _leave(self, ticket):
+        with self._cond:
+            ticket.waiters -= 1
+            if ticket.waiters > 0 or ticket.started or ticket.cancelled:
+                return
+            # Nobody is waiting any more: drop it before it uses any of the budget
+            ticket.cancelled = True
+            self._queued[ticket.priority] -= 1
+            self.cancelled[ticket.priority] += 1
+            if self._pending.get(ticket.path) is ticket:
+                del self._pending[ticket.path]
+
+    def _take_token(self):
+        # Returns 0 when a request may start now, otherwise seconds until the next token
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._token_time) * self.rate)
+        self._token_time = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _next(self):
+        while self._heap:
+            priority, _, ticket = heapq.heappop(self._heap)
+            # Skip cancelled tickets and entries superseded by a priority upgrade
+            if ticket.cancelled or ticket.started or priority != ticket.priority:
+                continue
+            return ticket
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not sum(self._queued):
+                        self._cond.wait()
+                        continue
+                    delay = self._take_token()
+                    if delay == 0:
+                        break
+                    self._cond.wait(delay)
+                # Picked after the token wait, so anything more urgent that arrived meanwhile goes first
+                ticket = self._next()
+                if ticket is None:
+                    self._tokens += 1
+                    continue
+                ticket.started = True
+                self._queued[ticket.priority] -= 1
+                self.in_flight += 1
+                self._waits[ticket.priority].append(time.monotonic() - ticket.enqueued_at)
+
+            try:
+                ticket.result = download(ticket.path, ticket.prune)
+            except UpstreamError as e:
+                ticket.error = e
+            except Exception as e:
+                ticket.error = UpstreamError(str(e))
+            finally:
+                with self._cond:
+                    self.in_flight -= 1
+                    self.completed[ticket.priority] += 1
+                    if self._pending.get(ticket.path) is ticket:
+                        del self._pending[ticket.path]
+                ticket.done.set()
+
+    def stats(self):
+        with self._cond:
+            queues = {}
+            for priority, name in enumerate(PRIORITY_NAMES):
+                waits = sorted(self._waits[priority])
+                queues[name] = {
+                    'queued': self._queued[priority],
+                    'completed': self.completed[priority],
+                    'shared': self.shared[priority],
+                    'cancelled': self.cancelled[priority],
+                    'rejected': self.rejected[priority],
+                    'waitMsAvg': round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+                    'waitMsP95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+                    'waitMsMax': round(waits[-1] * 1000, 1) if waits else None,
+                }
+            return {
+                'ratePerSecond': self.rate,
+                'workers': self.workers,
+                'queueMax': self.queue_max,
+                'inFlight': self.in_flight,
+                'liveYear': LIVE_YEAR,
+                'liveStage': self.live_stage,
+                'queues': queues,
+            }
+
+
+scheduler = UpstreamScheduler(UPSTREAM_RPS, UPSTREAM_WORKERS, UPSTREAM_QUEUE_MAX)
+
+
+def fetch_upstream(path, prune=None, priority=PRIORITY_LIVE, timeout=UPSTREAM_WAIT_SECONDS):
+    return scheduler.fetch(path, prune, priority, timeout)
+
+
+def snapshot_source(key):
+    # Returns (upstream path, prune, on_change) for a snapshot key
+    year, category, stage = key
+    if category == 'category':
+        return f"category-{year}", None, None
+    return f"lastScore-{year}-{category}-{stage}", prune_entry, last_score_changed
+
+
+def refresh_snapshot(key, snap=None):
+    path, prune, on_change = snapshot_source(key)
+    data, version, parse = fetch_upstream(path, prune, scheduler.priority(key))
+    if data and key[1] != 'category':
+        scheduler.note_stage(key[0], str(key[2]))
+    if snap is not None and snap.version == version:
+        # Unchanged upstream: keep the snapshot and everything derived from it
+        snap.fetched_at = time.time()
+        snap.stale = False
+        return snap
+    # Waiters on one deduplicated fetch all get here with the same document: only the first stores it
+    new_snap, previous, stored = cache.put_if_changed(key, data, version, parse)
+    if not stored:
+        return new_snap
+    if on_change is not None:
+        on_change(new_snap, previous if previous is not None else snap)
+    return new_snap
+
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_in_background(key, snap=None):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            refresh_snapshot(key, snap)
+        except UpstreamError as e:
+            print(f"Background refresh of {key} failed: {e}", file=sys.stderr)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_snapshot(key):
+    snap = cache.get(key)
+    if snap is not None and snap.stale:
+        # Restored from the warm-start file: serve it right away and refresh behind it
+        refresh_in_background(key, snap)
+        return snap
+    if snap is not None and time.time() - snap.fetched_at < DOC_TTL_SECONDS:
+        return snap
+    return refresh_snapshot(key, snap)
+
+
+def get_last_score_snapshot(year, category, stage):
+    return get_snapshot((year, category, stage))
+
+
+def get_category_snapshot(year):
+    return get_snapshot((year, 'category', None))
+
+
+def save_warm_start(path=SNAPSHOT_PATH):
+    # Latest lastScore and category documents, written atomically
+    snaps = cache.recent(SNAPSHOT_MAX_DOCUMENTS)
+    if not path or not snaps:
+        return
+    data = {
+        'savedAt': time.time(),
+        'documents': [
+            {'key': list(snap.key), 'version': snap.version, 'fetchedAt': snap.fetched_at, 'doc': snap.doc}
+            for snap in reversed(snaps)
+        ],
+    }
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def load_warm_start(path=SNAPSHOT_PATH):
+    # Restores saved documents marked stale; returns their keys
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring warm-start file {path}: {e}", file=sys.stderr)
+        return []
+    if not isinstance(data, dict):
+        print(f"Ignoring warm-start file {path}: not a snapshot", file=sys.stderr)
+        return []
+    keys = []
+    for item in data.get('documents', []):
+        try:
+            year, category, stage = item['key']
+            key = (year, category, stage)
+            fetched_at = float(item['fetchedAt'])
+            snap = cache.put(key, item['doc'], item['version'], {'parser': 'snapshot'})
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Skipping bad warm-start entry in {path}: {e!r}", file=sys.stderr)
+            continue
+        snap.fetched_at = fetched_at
+        snap.stale = True
+        keys.append(key)
+    return keys
+
+
+def start_warm_start():
+    keys = load_warm_start()
+
+    def refresh_all():
+        # Refresh everything restored, a few documents at a time, while the stale copies are served
+        from concurrent.futures import ThreadPoolExecutor
+
+        def refresh(key):
+            snap = cache.get(key)
+            if snap is not None and snap.stale:
+                try:
+                    refresh_snapshot(key, snap)
+                except UpstreamError as e:
+                    print(f"Warm-start refresh of {key} failed: {e}", file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(refresh, keys))
+
+    def save_periodically():
+        while True:
+            time.sleep(SNAPSHOT_SAVE_SECONDS)
+            try:
+                save_warm_start()
+            except OSError as e:
+                print(f"Saving warm-start file {SNAPSHOT_PATH} failed: {e}", file=sys.stderr)
+
+    if keys:
+        threading.Thread(target=refresh_all, daemon=True).start()
+    if SNAPSHOT_PATH:
+        threading.Thread(target=save_periodically, daemon=True).start()
+        atexit.register(save_warm_start)
+    return keys
+
+
+# Map actual class IDs from API (team.clazz) to class names.
+# 'original' is the team.is.obm flag rather than a class.
+CLASS_ID_MAP = {
+    # Cars (A) - Ultimate/T1+
+    'e18df6479eeb221edf506539ca01a0fb': 'ultimate',
+    'cd3a224fa3f90b3d44ad779de5a61de0': 'ultimate',
+    '56b1895a94e9bde92261fefdccfd9300': 'ultimate',
+    '8ec12cac9b3eb552e37a6f52f3eb874c': 'ultimate',
+    # Cars (A) - T3 Lightweight
+    '75ca283e010c2d8f55515206c945cc5b': 't3',
+    # Cars (A) - SSV
+    '21a677c34d3929cb01e5e7163a1dda0c': 'ssv',
+    'fa9bd58337b8e5a6c01aea95af09dda7': 'ssv',
+    # Cars (A) - Stock/T2
+    'f92c26257b0bc1bf01d1ed3406a2798e': 'stock',
+    '25ab9f4ea3d9f41969b2b47f627168aa': 'stock',
+    # Cars (A) - Trucks
+    '596e4eb3814731d718603e5313878fd2': 'trucks',
+    '0aca7403b23b1d4308e5e124290e09bc': 'trucks',
+    # Bikes (M) - RallyGP (top factory riders)
+    'bb94ac9163db104dfb3b5f878235edb9': 'rallygp',
+    # Bikes (M) - Rally2 (larger field)
+    '978032dc39dd0c9245c7bc4097a72ac0': 'rally2',
+}
+
+# Nationality code to flag, also used by the page
+FLAGS = {
+    'fra': '🇫🇷', 'esp': '🇪🇸', 'ger': '🇩🇪', 'GER': '🇩🇪', 'aus': '🇦🇺', 'arg': '🇦🇷',
+    'qat': '🇶🇦', 'ksa': '🇸🇦', 'KSA': '🇸🇦', 'bel': '🇧🇪', 'por': '🇵🇹', 'POR': '🇵🇹', 'ned': '🇳🇱', 'NED': '🇳🇱',
+    'cze': '🇨🇿', 'pol': '🇵🇱', 'bra': '🇧🇷', 'jpn': '🇯🇵', 'chn': '🇨🇳',
+    'rsa': '🇿🇦', 'RSA': '🇿🇦', 'aut': '🇦🇹', 'chi': '🇨🇱', 'CHI': '🇨🇱', 'ltu': '🇱🇹', 'nzl': '🇳🇿',
+    'usa': '🇺🇸', 'gbr': '🇬🇧', 'ita': '🇮🇹', 'mex': '🇲🇽', 'lux': '🇱🇺',
+    'ecu': '🇪🇨', 'kaz': '🇰🇿', 'ang': '🇦🇴', 'ANG': '🇦🇴', 'moz': '🇲🇿', 'rou': '🇷🇴',
+    'sui': '🇨🇭', 'SUI': '🇨🇭', 'svk': '🇸🇰', 'svn': '🇸🇮', 'ukr': '🇺🇦', 'ind': '🇮🇳',
+    'sau': '🇸🇦', 'SAU': '🇸🇦', 'uae': '🇦🇪', 'UAE': '🇦🇪', 'bhr': '🇧🇭', 'kwt': '🇰🇼',
+    'col': '🇨🇴', 'per': '🇵🇪', 'ury': '🇺🇾', 'crc': '🇨🇷', 'rus': '🇷🇺',
+}
+
+# Display names per class, as in the page's CLASS_CONFIG
+CLASS_LABELS = {
+    'all': 'All', 'ultimate': 'Ultimate', 't3': 'T3 Lightweight', 'ssv': 'SSV', 'stock': 'Stock',
+    'trucks': 'Trucks', 'rallygp': 'RallyGP', 'rally2': 'Rally2', 'original': 'Original by Motul',
+}
+
+# Display names per category, for categories (Classic, Mission 1000) without a class map
+CATEGORY_LABELS = {'M': 'Bikes', 'A': 'Cars', 'T': 'Trucks', 'K': 'Classic', 'F': 'Mission 1000'}
+
+# Categories that are a filtered view of another category's document (Trucks use Cars API)
+CATEGORY_VIEWS = {
+    'T': ('A', 'trucks'),
+}
+
+
+def resolve_category(category, cls='all'):
+    # Returns (upstream category, class filter)
+    if category in CATEGORY_VIEWS:
+        return CATEGORY_VIEWS[category]
+    return category, cls or 'all'
+
+
+def entry_class(entry):
+    clazz = (entry.get('team') or {}).get('clazz')
+    return CLASS_ID_MAP.get(clazz, 'unknown')
+
+
+def filter_class(entries, cls):
+    if not isinstance(entries, list):
+        return []
+    if cls == 'all':
+        return entries
+    if cls == 'original':
+        # Original by Motul is a flag, not a class
+        return [e for e in entries if ((e.get('team') or {}).get('is') or {}).get('obm')]
+    return [e for e in entries if entry_class(e) == cls]
+
+
+def driver_name(team):
+    competitors = (team or {}).get('competitors') or []
+    if not competitors:
+        return 'Unknown'
+    driver = next((c for c in competitors if c.get('role') == 'P'), competitors[0])
+    return driver.get('name') or f"{driver.get('firstName')} {driver.get('lastName')}"
+
+
+def is_waypoint(key):
+    return 'penality' not in key and 'ASS' not in key and 'PASS' not in key
+
+
+def waypoint_order(key):
+    # Sort key for waypoint names: wp2 before wp10, names without a number last
+    digits = key[len(key.rstrip('0123456789')):]
+    return (int(digits) if digits else float('inf'), key)
+
+
+def stage_waypoints(entries):
+    wps = set()
+    for entry in entries:
+        wps.update(wp for wp in (entry.get('cs') or {}) if is_waypoint(wp))
+    return sorted(wps, key=waypoint_order)
+
+
+def absolute_time(timing):
+    # cs/cg waypoint values carry the time in ms as absolute[0]
+    absolute = (timing or {}).get('absolute') or [None]
+    return absolute[0] or None
+
+
+def compute_segments(entries):
+    waypoints = stage_waypoints(entries)
+
+    # Single pass over the field: per-entry segment times plus per-segment columns for ranking
+    rows = []
+    columns = [[] for _ in waypoints]
+    for idx, entry in enumerate(entries):
+        cs = entry.get('cs') or {}
+        previous = 0  # segment 1 runs from the start
+        times = []
+        for col, wp in enumerate(waypoints):
+            current = absolute_time(cs.get(wp))
+            segment = current - previous if current is not None and previous is not None else None
+            previous = current
+            times.append(segment)
+            if segment is not None:
+                columns[col].append((segment, idx))
+        rows.append(times)
+
+    segments = []
+    ranks = [{} for _ in waypoints]
+    for col, column in enumerate(columns):
+        column.sort()
+        rank = 0
+        last_time = None
+        for pos, (segment, idx) in enumerate(column):
+            if segment != last_time:
+                rank = pos + 1
+                last_time = segment
+            ranks[col][idx] = rank
+        best, best_idx = column[0] if column else (None, None)
+        segments.append({
+            'from': waypoints[col - 1] if col else 'start',
+            'to': waypoints[col],
+            'best': best,
+            'bestBib': (entries[best_idx].get('team') or {}).get('bib') if column else None,
+            'count': len(column),
+        })
+
+    ideal_time = sum(seg['best'] for seg in segments if seg['best'] is not None)
+
+    results = []
+    for idx, entry in enumerate(entries):
+        entry_segments = []
+        time_lost = 0
+        for col, segment in enumerate(rows[idx]):
+            if segment is None:
+                entry_segments.append(None)
+                continue
+            lost = segment - segments[col]['best']
+            time_lost += lost
+            entry_segments.append({'time': segment, 'rank': ranks[col][idx], 'lost': lost})
+        results.append({
+            'bib': (entry.get('team') or {}).get('bib'),
+            'segments': entry_segments,
+            'timeLost': time_lost,
+        })
+
+    return {
+        'waypoints': waypoints,
+        'segments': segments,
+        'idealTime': ideal_time,
+        'entries': results,
+    }
+
+
+def compute_pace_ratios(entries, waypoints):
+    # For each waypoint index k, the median ratio t(k+1)/t(k) and t(finish)/t(k) over drivers
+    # who already passed both points. Done once per document so each projection is O(1).
+    finish = len(waypoints) - 1
+    times = [[absolute_time((e.get('cs') or {}).get(wp)) for wp in waypoints] for e in entries]
+    to_next = [[] for _ in waypoints]
+    to_finish = [[] for _ in waypoints]
+    for row in times:
+        for k, t in enumerate(row):
+            if t is None:
+                continue
+            if k < finish and row[k + 1] is not None:
+                to_next[k].append(row[k + 1] / t)
+            if k < finish and row[finish] is not None:
+                to_finish[k].append(row[finish] / t)
+    # Drivers that have not reached the first waypoint are projected from the field's median times
+    first = [row[0] for row in times if row[0] is not None]
+    finished = [row[finish] for row in times if row[finish] is not None]
+    return {
+        'next': [statistics.median(r) if r else None for r in to_next],
+        'finish': [statistics.median(r) if r else None for r in to_finish],
+        'firstTime': statistics.median(first) if first else None,
+        'finishTime': statistics.median(finished) if finished else None,
+    }
+
+
+def compute_projections(entries, pace, waypoints):
+    if not waypoints:
+        return {'waypoints': [], 'finish': None, 'entries': []}
+
+    finish = len(waypoints) - 1
+    finish_wp = waypoints[finish]
+
+    ranked = []
+    projections = []
+    for entry in entries:
+        cs = entry.get('cs') or {}
+        bib = (entry.get('team') or {}).get('bib')
+        finish_time = absolute_time(cs.get(finish_wp))
+        if finish_time:
+            ranked.append((finish_time, bib))
+            continue
+        if not (entry.get('dss') or {}).get('real'):
+            continue
+
+        # On stage: project from the last waypoint this driver reached
+        last = None
+        for k in range(finish - 1, -1, -1):
+            if absolute_time(cs.get(waypoints[k])):
+                last = k
+                break
+
+        if last is None:
+            basis = 'field'
+            next_wp = waypoints[0]
+            next_time = pace['firstTime']
+            finish_time = pace['finishTime']
+        else:
+            basis = 'pace'
+            t = absolute_time(cs.get(waypoints[last]))
+            next_wp = waypoints[last + 1]
+            next_time = t * pace['next'][last] if pace['next'][last] else None
+            # Never project a finish earlier than the time already on the clock
+            finish_time = max(t * pace['finish'][last], t) if pace['finish'][last] else None
+
+        projection = {
+            'bib': bib,
+            'lastWaypoint': waypoints[last] if last is not None else None,
+            'nextWaypoint': next_wp,
+            'nextTime': round(next_time) if next_time else None,
+            'finishTime': round(finish_time) if finish_time else None,
+            'projectedPos': None,
+            'basis': basis,
+        }
+        projections.append(projection)
+        # The field median says nothing about this driver's pace, so it is not ranked
+        if basis == 'pace' and projection['finishTime']:
+            ranked.append((projection['finishTime'], bib))
+
+    # Projected class position: actual finish times and pace-based projections ranked together
+    ranked.sort(key=lambda r: r[0])
+    positions = {bib: pos for pos, (_, bib) in enumerate(ranked, 1)}
+    for projection in projections:
+        if projection['basis'] == 'pace' and projection['finishTime']:
+            projection['projectedPos'] = positions[projection['bib']]
+
+    return {'waypoints': waypoints, 'finish': finish_wp, 'entries': projections}
+
+
+def driver_photo(team):
+    competitors = (team or {}).get('competitors') or []
+    if not competitors:
+        return None
+    driver = next((c for c in competitors if c.get('role') == 'P'), competitors[0])
+    return driver.get('profil_sm') or driver.get('profil') or None
+
+
+def index_names_by_id(doc):
+    # {_id: name} for every object in the category document that has both
+    names = {}
+    stack = [doc]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            ident = item.get('_id') or item.get('id')
+            name = item.get('name') or item.get('label')
+            if isinstance(ident, str) and isinstance(name, str):
+                names[ident] = name
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return names
+
+
+class TeamRegistry:
+    # Static per-bib team data for one (year, category), built once and versioned.
+    # Extended only when a document brings bibs it has not seen.
+    def __init__(self, year):
+        self.year = year
+        self.teams = {}
+        self.version = None
+        self.body = None
+        self._lock = threading.Lock()
+        self._unknown_classes = set()
+
+    def update(self, entries):
+        # Entries without a team (no bib) can't be looked up by the page, so they are skipped
+        new = [e for e in entries if (e.get('team') or {}).get('bib') not in self.teams
+               and (e.get('team') or {}).get('bib') is not None]
+        if not new and self.version is not None:
+            return self.version
+        # The category document may need an upstream fetch: done before taking the lock so
+        # other requests for this category are not held up behind the scheduler
+        classes = {(e.get('team') or {}).get('clazz') for e in new}
+        unknown = any(clazz and clazz not in CLASS_ID_MAP for clazz in classes)
+        labels = self._category_labels() if unknown else {}
+        with self._lock:
+            # Built aside and swapped in at the end, so a failure can't leave a half-updated registry
+            teams = dict(self.teams)
+            for entry in new:
+                team = entry.get('team') or {}
+                clazz = team.get('clazz')
+                class_name = CLASS_ID_MAP.get(clazz, 'unknown') if clazz else 'unknown'
+                if clazz and class_name == 'unknown':
+                    if clazz not in self._unknown_classes:
+                        self._unknown_classes.add(clazz)
+                        print(f"Unknown class ID: {clazz} ({labels.get(clazz, 'no label')}) - add to CLASS_ID_MAP",
+                              file=sys.stderr)
+                flags = team.get('is') or {}
+                teams[team.get('bib')] = {
+                    'driver': driver_name(team),
+                    'driverPhoto': driver_photo(team),
+                    'nationality': ((team.get('competitors') or [{}])[0]).get('nationality'),
+                    'brand': team.get('brand'),
+                    'model': team.get('model'),
+                    'vehicle': team.get('vehicle'),
+                    'clazzId': clazz,
+                    'clazzName': class_name,
+                    'classLabel': labels.get(clazz),
+                    'isW2RC': flags.get('w2rc'),
+                    'isOBM': flags.get('obm'),
+                }
+            body = json.dumps({'teams': teams}, sort_keys=True, separators=(',', ':'))
+            version = hashlib.sha1(body.encode('utf-8')).hexdigest()[:16]
+            payload = json.dumps({'version': version, 'teams': teams}, separators=(',', ':')).encode('utf-8')
+            self.teams, self.version, self.body = teams, version, payload
+            return version
+
+    def _category_labels(self):
+        # Readable names for class IDs missing from CLASS_ID_MAP, if the category document has them
+        try:
+            return index_names_by_id(get_category_snapshot(self.year).doc)
+        except UpstreamError:
+            return {}
+
+
+registries = {}
+_registries_lock = threading.Lock()
+
+
+def team_registry(year, category):
+    with _registries_lock:
+        if (year, category) not in registries:
+            registries[(year, category)] = TeamRegistry(year)
+        return registries[(year, category)]
+
+
+def timing_entries(snap):
+    # Per-poll payload: bib-keyed timing only, static team data lives in the registry.
+    # The registry version is added per request, it can move on after this is cached.
+    entries = snap.doc if isinstance(snap.doc, list) else []
+    return json.dumps([
+        {
+            'bib': (e.get('team') or {}).get('bib'),
+            'dss': e.get('dss') or {},
+            'cs': e.get('cs') or {},
+            'cg': e.get('cg') or {},
+            'ce': e.get('ce') or {},
+        }
+        for e in entries
+    ], separators=(',', ':')).encode('utf-8')
+
+
+# Classic and Mission 1000 use ce (classification) positions instead of waypoints
+CE_RANKING_CATEGORIES = {'K', 'F'}
+
+
+def compute_standings(entries, ce_ranking=False):
+    # Server-side equivalent of processData's positions for one class
+    if ce_ranking:
+        rows = []
+        for entry in entries:
+            position = ((entry.get('ce') or {}).get('position') or [None])[0]
+            rows.append({
+                'bib': (entry.get('team') or {}).get('bib'),
+                'stagePos': position,
+                'stageTime': None,
+                'stageGap': None,
+                'overallPos': position,
+                'overallTime': None,
+                'overallGap': None,
+            })
+        return {'waypoint': None, 'entries': rows}
+
+    waypoints = stage_waypoints(entries)
+
+    # Find the furthest waypoint that ANY entry has reached
+    furthest = None
+    for wp in waypoints:
+        if any(absolute_time((e.get('cs') or {}).get(wp)) for e in entries):
+            furthest = wp
+
+    rows = [{
+        'bib': (entry.get('team') or {}).get('bib'),
+        'stagePos': None,
+        'stageTime': None,
+        'stageGap': None,
+        'overallPos': None,
+        'overallTime': None,
+        'overallGap': None,
+    } for entry in entries]
+
+    if furthest is not None:
+        for field, timing in (('stage', 'cs'), ('overall', 'cg')):
+            ranked = []
+            for row, entry in zip(rows, entries):
+                t = absolute_time((entry.get(timing) or {}).get(furthest))
+                if t:
+                    ranked.append((t, row))
+            ranked.sort(key=lambda r: r[0])
+            leader = ranked[0][0] if ranked else 0
+            for pos, (t, row) in enumerate(ranked, 1):
+                row[field + 'Pos'] = pos
+                row[field + 'Time'] = t
+                row[field + 'Gap'] = t - leader
+
+    return {'waypoint': furthest, 'entries': rows}
+
+
+def class_standings(snap, cls):
+    # Standings for one class of a document, computed once per document version
+    category = snap.key[1]
+    return cache.memo(snap, ('standings', cls),
+                      lambda: compute_standings(filter_class(snap.doc, cls), category in CE_RANKING_CATEGORIES))
+
+
+# Classes shown per category, as in the page's CLASS_CONFIG
+CATEGORY_CLASSES = {
+    'A': ['all', 'ultimate', 't3', 'ssv', 'stock', 'trucks'],
+    'M': ['all', 'rallygp', 'rally2', 'original'],
+    'T': ['all'],
+    'K': ['all'],
+    'F': ['all'],
+}
+
+
+def wall_category(snap, category, top):
+    year, api_category, _ = snap.key
+    teams = team_registry(year, api_category)
+    teams.update(snap.doc if isinstance(snap.doc, list) else [])
+    classes = []
+    for cls in CATEGORY_CLASSES.get(category, ['all']):
+        _, filter_cls = resolve_category(category, cls)
+        standings = class_standings(snap, filter_cls)
+        ranked = sorted((row for row in standings['entries'] if row['stagePos']), key=lambda row: row['stagePos'])
+        classes.append({
+            'class': cls,
+            'waypoint': standings['waypoint'],
+            'count': len(standings['entries']),
+            'entries': [dict(row, **{k: teams.teams.get(row['bib'], {}).get(k)
+                                     for k in ('driver', 'nationality', 'brand', 'model')})
+                        for row in ranked[:top]],
+        })
+    return {'category': category, 'version': snap.version, 'stale': snap.stale, 'classes': classes}
+
+
+def get_flag(nat):
+    if not nat:
+        return '🏁'
+    return FLAGS.get(nat.lower()) or FLAGS.get(nat) or '🏁'
+
+
+def format_time(ms):
+    if not ms:
+        return '-'
+    secs = int(ms // 1000)
+    h, m, sec = secs // 3600, (secs % 3600) // 60, secs % 60
+    if h > 0:
+        return f"{h}:{m:02d}:{sec:02d}"
+    return f"{m}:{sec:02d}"
+
+
+def format_gap(ms):
+    if not ms:
+        return '-'
+    return ('+' if ms > 0 else '-') + format_time(abs(ms))
+
+
+def compute_table(snap, cls):
+    # Server-side equivalent of processData for one class: rows plus per-waypoint class positions
+    year, api_category, _ = snap.key
+    ce_ranking = api_category in CE_RANKING_CATEGORIES
+    entries = filter_class(snap.doc, cls)
+    teams = team_registry(year, api_category)
+    teams.update(snap.doc if isinstance(snap.doc, list) else [])
+    standings = class_standings(snap, cls)
+    waypoints = [] if ce_ranking else stage_waypoints(filter_class(snap.doc, 'all'))
+
+    rows = []
+    for entry, standing in zip(entries, standings['entries']):
+        cs = entry.get('cs') or {}
+        cg = entry.get('cg') or {}
+        dss = entry.get('dss') or {}
+        rows.append(dict(
+            standing,
+            team=teams.teams.get(standing['bib'], {}),
+            startPos=dss.get('position'),
+            hasStarted=bool(dss.get('real')),
+            waypoints={wp: {'stageTime': absolute_time(cs.get(wp)), 'overallTime': absolute_time(cg.get(wp))}
+                       for wp in waypoints if wp in cs or wp in cg},
+        ))
+
+    for wp in waypoints:
+        ranked = sorted((r for r in rows if (r['waypoints'].get(wp) or {}).get('stageTime')),
+                        key=lambda r: r['waypoints'][wp]['stageTime'])
+        leader = ranked[0]['waypoints'][wp]['stageTime'] if ranked else 0
+        for pos, row in enumerate(ranked, 1):
+            row['waypoints'][wp]['classPos'] = pos
+            row['waypoints'][wp]['classGap'] = row['waypoints'][wp]['stageTime'] - leader
+
+    return {'ceRanking': ce_ranking, 'waypoint': standings['waypoint'], 'waypoints': waypoints, 'rows': rows}
+
+
+def sort_rows(rows, column):
+    # Same order as sortAndRender in the page: always P1 to last, missing values at the end
+    def key(row):
+        if column == 'classStagePos':
+            value = row['stagePos']
+        elif column == 'classOverallPos':
+            value = row['overallPos']
+        elif column == 'startPos':
+            value = row['startPos']
+        elif column == 'bib':
+            value = row['bib']
+        elif column.startswith('wp_'):
+            value = (row['waypoints'].get(column[3:]) or {}).get('classPos')
+        else:
+            value = 0
+        return value or 9999
+    return sorted(rows, key=key)
+
+
+def render_fragment(table, cls, column):
+    # Standings table markup for thin clients; styles live in THIN_TEMPLATE
+    esc = html.escape
+    rows = sort_rows(table['rows'], column)
+    ce_ranking = table['ceRanking']
+    comparison_wp = table['waypoint']
+    waypoints = table['waypoints']
+
+    ranked = sum(1 for r in rows if r['stagePos'])
+    stats = [f"<b>{esc(CLASS_LABELS.get(cls, cls))}</b>", f"🏁 <b>{len(rows)}</b> Competitors"]
+    if ce_ranking:
+        stats.append(f"📊 <b>{ranked}</b> Ranked")
+    else:
+        on_stage = sum(1 for r in rows if r['hasStarted'] and not r['stagePos'])
+        waiting = sum(1 for r in rows if not r['hasStarted'])
+        stats += [f"📍 <b>{ranked}</b> At Waypoints", f"🚗 <b>{on_stage}</b> On Stage", f"⏳ <b>{waiting}</b> Waiting"]
+    parts = ['<div class="stats">', ''.join(f'<span>{item}</span>' for item in stats), '</div>']
+
+    if not rows:
+        parts.append('<p class="empty">No competitors in this class for the selected stage</p>')
+        return ''.join(parts)
+
+    def th(label, col, extra=''):
+        classes = ' '.join(c for c in (extra, 'active' if col == column else '') if c)
+        attr = f' class="{classes}"' if classes else ''
+        return f'<th{attr} data-sort="{esc(col)}">{label}</th>'
+
+    position_label = 'Overall' if ce_ranking else (f"@WP{comparison_wp[2:]}" if comparison_wp else 'in Class')
+    parts.append('<table class="standings"><thead><tr><th class="driver">Driver / Vehicle</th>')
+    if not ce_ranking:
+        parts.append(th('Start', 'startPos'))
+        parts.extend(th(f"WP{esc(wp[2:])}", f"wp_{wp}", 'wp') for wp in waypoints)
+    parts.append(th(f'Position<small>{esc(position_label)}</small>', 'classOverallPos', 'pos'))
+    parts.append('</tr></thead><tbody>')
+
+    for idx, row in enumerate(rows):
+        team = row['team']
+        podium = f" p{row['stagePos']}" if row['stagePos'] in (1, 2, 3) else ''
+        stripe = ' w2rc' if team.get('isW2RC') else (' odd' if idx % 2 else '')
+        flag = get_flag(team.get('nationality'))
+        parts.append(f'<tr class="row{stripe}"><td class="driver{podium}">'
+                     f'<span class="bib">{esc(str(row["bib"]))}</span> {flag} <b>{esc(team.get("driver") or "Unknown")}</b>'
+                     f'<small>{esc(team.get("brand") or "")} {esc(team.get("model") or "")}</small></td>')
+        if not ce_ranking:
+            parts.append(f'<td>{esc(str(row["startPos"] or "-"))}<small>{"✓ GO" if row["hasStarted"] else "⏳"}</small></td>')
+            for wp in waypoints:
+                data = row['waypoints'].get(wp) or {}
+                if data.get('stageTime'):
+                    top = ' class="top"' if data.get('classPos', 99) <= 3 else ''
+                    parts.append(f'<td class="wp"><b{top}>P{data.get("classPos") or "-"}</b>'
+                                 f'<small>{format_time(data["stageTime"])}</small>'
+                                 f'<small class="gap">{format_gap(data.get("classGap"))}</small></td>')
+                else:
+                    parts.append('<td class="wp none">-</td>')
+        if row['overallPos']:
+            cell = f'<b>P{row["overallPos"]}</b>'
+            if not ce_ranking:
+                overall = (row['waypoints'].get(comparison_wp) or {}).get('overallTime') if comparison_wp else None
+                cell += f'<small>{format_time(overall)}</small><small class="gap">{format_gap(row["overallGap"])}</small>'
+        else:
+            cell = '<span class="none">—</span>'
+        parts.append(f'<td class="pos">{cell}</td></tr>')
+
+    parts.append('</tbody></table>')
+    return ''.join(parts)
+
+
+# Sort columns of the table besides wp_<waypoint>, as in the page
+SORT_COLUMNS = {'classStagePos', 'classOverallPos', 'startPos', 'bib'}
+
+
+def fragment_table(snap, cls):
+    return cache.memo(snap, ('table', cls), lambda: compute_table(snap, cls))
+
+
+def is_sort_column(table, column):
+    # Only columns the table can show, so a query string can't fill the cache with variants
+    if column.startswith('wp_'):
+        return column[3:] in table['waypoints']
+    return column in SORT_COLUMNS
+
+
+def fragment_gzip(snap, cls, column):
+    # Rendered and compressed once per (document version, class, sort column)
+    def render():
+        return gzip.compress(render_fragment(fragment_table(snap, cls), cls, column).encode('utf-8'), 6)
+    return cache.memo(snap, ('fragment', cls, column), render)
+
+
+class PositionHistory:
+    # Per (year, bib) and stage: parallel arrays of poll time, waypoint, stage position and overall position
+    def __init__(self, path=None):
+        self.path = path
+        self._series = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # one writer of the history file at a time
+        self._dirty = False
+
+    def _stage_series(self, year, bib, stage):
+        stages = self._series.setdefault((year, bib), {})
+        if stage not in stages:
+            stages[stage] = {
+                'waypoints': [],
+                't': array('d'),
+                'wp': array('h'),       # index into waypoints, -1 when none reached
+                'stage': array('h'),    # 0 when no position
+                'overall': array('h'),
+            }
+        return stages[stage]
+
+    def record(self, year, stage, timestamp, rows):
+        # rows: (bib, waypoint, stage position, overall position); unchanged points are skipped
+        with self._lock:
+            for bib, wp, stage_pos, overall_pos in rows:
+                series = self._stage_series(year, bib, stage)
+                if wp is None:
+                    wp_idx = -1
+                else:
+                    if wp not in series['waypoints']:
+                        series['waypoints'].append(wp)
+                    wp_idx = series['waypoints'].index(wp)
+                point = (wp_idx, stage_pos or 0, overall_pos or 0)
+                if len(series['t']) and point == (series['wp'][-1], series['stage'][-1], series['overall'][-1]):
+                    continue
+                series['t'].append(timestamp)
+                series['wp'].append(point[0])
+                series['stage'].append(point[1])
+                series['overall'].append(point[2])
+                self._dirty = True
+
+    def query(self, year, bib, stage=None):
+        with self._lock:
+            stages = self._series.get((year, bib), {})
+            selected = [stage] if stage is not None else sorted(stages, key=lambda s: int(s) if s.isdigit() else s)
+            result = {}
+            for st in selected:
+                series = stages.get(st)
+                if series is None:
+                    continue
+                wps = series['waypoints']
+                result[st] = [
+                    {
+                        't': t,
+                        'waypoint': wps[wp] if wp >= 0 else None,
+                        'stagePos': sp or None,
+                        'overallPos': op or None,
+                    }
+                    for t, wp, sp, op in zip(series['t'], series['wp'], series['stage'], series['overall'])
+                ]
+            return result
+
+    def save(self, only_if_dirty=False):
+        with self._save_lock:
+            with self._lock:
+                if only_if_dirty and not self._dirty:
+                    return
+                data = [
+                    [year, bib, stage, series['waypoints'], series['t'].tolist(), series['wp'].tolist(),
+                     series['stage'].tolist(), series['overall'].tolist()]
+                    for (year, bib), stages in self._series.items()
+                    for stage, series in stages.items()
+                ]
+                self._dirty = False
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring history file {self.path}: {e}", file=sys.stderr)
+            return
+        with self._lock:
+            for item in data:
+                try:
+                    year, bib, stage, waypoints, t, wp, stage_pos, overall_pos = item
+                    arrays = (array('d', t), array('h', wp), array('h', stage_pos), array('h', overall_pos))
+                    series = self._stage_series(year, bib, stage)
+                except (TypeError, ValueError, OverflowError) as e:
+                    print(f"Skipping bad history entry in {self.path}: {e}", file=sys.stderr)
+                    continue
+                series['waypoints'] = waypoints
+                series['t'], series['wp'], series['stage'], series['overall'] = arrays
+
+
+history = PositionHistory(HISTORY_PATH)
+
+
+def start_history():
+    history.load()
+    if not history.path:
+        return
+
+    def save_periodically():
+        while True:
+            time.sleep(HISTORY_SAVE_SECONDS)
+            try:
+                history.save(only_if_dirty=True)
+            except OSError as e:
+                print(f"Saving position history to {history.path} failed: {e}", file=sys.stderr)
+
+    threading.Thread(target=save_periodically, daemon=True).start()
+    atexit.register(history.save)
+
+
+class EventFeed:
+    # Typed change events in a bounded ring buffer, detected by comparing each new document with the last
+    STATE_MAX = 64  # documents tracked at once
+
+    def __init__(self, maxlen):
+        self._events = deque(maxlen=maxlen)
+        self._next_id = 1
+        # Ids restart with the process; clients that see a new epoch start again from since=0
+        self.epoch = int(time.time() * 1000)
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _label(category, cls):
+        if cls in CLASS_LABELS:
+            return CLASS_LABELS[cls]
+        return CATEGORY_LABELS.get(category, category)
+
+    def _emit(self, key, now, kind, bib, cls, message, **data):
+        year, category, stage = key
+        self._events.append(dict(data, id=self._next_id, t=now, type=kind, year=year, category=category,
+                                 stage=stage, bib=bib, **{'class': cls}, message=message))
+        self._next_id += 1
+
+    def since(self, since=0, epoch=None, **filters):
+        if epoch is not None and epoch != self.epoch:
+            # Ids from before a restart mean nothing now
+            since = 0
+        with self._lock:
+            last = self._next_id - 1
+            result = []
+            for event in reversed(self._events):
+                if event['id'] <= since:
+                    break
+                if all(value is None or event[name] == value for name, value in filters.items()):
+                    result.append(event)
+        result.reverse()
+        return {'epoch': self.epoch, 'last': last, 'events': result}
+
+    def detect(self, snap):
+        key = snap.key
+        now = snap.fetched_at
+        entries = snap.doc if isinstance(snap.doc, list) else []
+
+        with self._lock:
+            state = self._state.get(key)
+            priming = state is None
+            if priming:
+                state = {'bibs': {}, 'leaders': {}, 'best': {}, 'stalled': set(), 'heap': []}
+                self._state[key] = state
+                if len(self._state) > self.STATE_MAX:
+                    self._state.popitem(last=False)
+            self._state.move_to_end(key)
+
+            bibs = state['bibs']
+            seen = set()
+            by_class = {}
+            fronts = {}
+            changed_classes = set()
+
+            for entry in entries:
+                team = entry.get('team') or {}
+                bib = team.get('bib')
+                if bib is None:
+                    continue
+                seen.add(bib)
+                cls = entry_class(entry)
+                by_class.setdefault(cls, []).append(entry)
+                cs = entry.get('cs') or {}
+                wps = [wp for wp in cs if is_waypoint(wp) and absolute_time(cs[wp])]
+                latest = max(wps, key=waypoint_order) if wps else None
+                if latest and (cls not in fronts or waypoint_order(latest) > waypoint_order(fronts[cls])):
+                    fronts[cls] = latest
+                signature = (len(wps), latest and absolute_time(cs[latest]),
+                             ((entry.get('ce') or {}).get('position') or [None])[0])
+
+                # Cheap signature check first: only changed entries are analysed further
+                known = bibs.get(bib)
+                if known is not None and known['signature'] == signature:
+                    continue
+                changed_classes.add(cls)
+                if known is None:
+                    known = bibs[bib] = {'wps': set(), 'last': None, 'moved': None}
+                known['signature'] = signature
+                known['cls'] = cls
+
+                new_wps = sorted(set(wps) - known['wps'], key=waypoint_order)
+                ordered = sorted(wps, key=waypoint_order)
+                for wp in new_wps:
+                    idx = ordered.index(wp)
+                    t = absolute_time(cs[wp])
+                    segment = t - absolute_time(cs[ordered[idx - 1]]) if idx else t
+                    segment_from = ordered[idx - 1] if idx else 'start'
+                    best_key = (cls, segment_from, wp)
+                    best = state['best'].get(best_key)
+                    if best is None or segment < best:
+                        state['best'][best_key] = segment
+                    if priming:
+                        continue
+                    self._emit(key, now, 'waypoint', bib, cls, f"#{bib} reached {wp}", waypoint=wp, time=t)
+                    if best is not None and segment - best >= EVENT_TIME_LOSS_MINUTES * 60000:
+                        lost = segment - best
+                        self._emit(key, now, 'time_loss', bib, cls,
+                                   f"#{bib} lost {round(lost / 60000)} min to the {self._label(key[1], cls)} best "
+                                   f"between {segment_from} and {wp}",
+                                   waypoint=wp, lost=lost)
+
+                known['wps'].update(new_wps)
+                if new_wps or (known['moved'] is None and (entry.get('dss') or {}).get('real')):
+                    known['last'] = ordered[-1] if ordered else None
+                    known['moved'] = now
+                    state['stalled'].discard(bib)
+                    heapq.heappush(state['heap'], (now, bib))
+
+            # Entries that dropped out of the document (an empty document is treated as a glitch)
+            if entries:
+                for bib in [b for b in bibs if b not in seen]:
+                    cls = bibs.pop(bib)['cls']
+                    if not priming:
+                        self._emit(key, now, 'retired', bib, cls, f"#{bib} is no longer in the results")
+
+            # Leaders are only recomputed for classes with a changed entry
+            for cls in changed_classes:
+                standings = compute_standings(by_class.get(cls, []), key[1] in CE_RANKING_CATEGORIES)
+                leader = next((row['bib'] for row in standings['entries'] if row['stagePos'] == 1), None)
+                previous = state['leaders'].get(cls)
+                if leader is not None and leader != previous:
+                    state['leaders'][cls] = leader
+                    if not priming and previous is not None:
+                        self._emit(key, now, 'lead_change', leader, cls,
+                                   f"New stage leader in {self._label(key[1], cls)}: #{leader}",
+                                   waypoint=standings['waypoint'], previous=previous)
+
+            # Stalls: pop only entries whose last move is older than the threshold
+            cutoff = now - EVENT_STALL_MINUTES * 60
+            requeue = []
+            heap = state['heap']
+            while heap and heap[0][0] <= cutoff:
+                moved, bib = heapq.heappop(heap)
+                known = bibs.get(bib)
+                if known is None or known['moved'] != moved or bib in state['stalled']:
+                    continue
+                # Entries at their class's furthest waypoint have nowhere known to go yet
+                if known['last'] == fronts.get(known['cls']):
+                    requeue.append((moved, bib))
+                    continue
+                state['stalled'].add(bib)
+                self._emit(key, now, 'stalled', bib, known['cls'],
+                           f"#{bib} has not reached a new waypoint for {round((now - moved) / 60)} min",
+                           waypoint=known['last'], since=moved)
+            for item in requeue:
+                heapq.heappush(heap, item)
+
+
+events = EventFeed(EVENTS_MAX)
+
+
+def last_score_changed(snap, previous):
+    # Called once per new upstream document version
+    year, category, stage = snap.key
+    rows = []
+    if isinstance(snap.doc, list):
+        by_class = {}
+        for entry in snap.doc:
+            by_class.setdefault(entry_class(entry), []).append(entry)
+        for entries in by_class.values():
+            standings = compute_standings(entries, category in CE_RANKING_CATEGORIES)
+            for row in standings['entries']:
+                if row['bib'] is not None:
+                    rows.append((row['bib'], standings['waypoint'], row['stagePos'], row['overallPos']))
+    history.record(year, stage, snap.fetched_at, rows)
+    events.detect(snap)
+
+
+# Distinct upstream documents (Trucks are part of Cars)
+EXPORT_CATEGORIES = ['M', 'A', 'K', 'F']
+
+EXPORT_COLUMNS = ['year', 'category', 'class', 'stage', 'bib', 'driver', 'brand', 'model',
+                  'waypoint', 'stage_time', 'overall_time', 'ce_position']
+
+
+def parse_stages(spec):
+    # "0-13" or "1,3,5-7"
+    stages = []
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            stages.extend(range(int(first), int(last) + 1))
+        elif part:
+            stages.append(int(part))
+    return stages
+
+
+def fetch_documents(paths, workers=EXPORT_WORKERS):
+    # Yields (document, error) in order with at most `workers` fetched or in flight at any time.
+    # Bypasses the snapshot cache so a bulk export can't evict the live stage, and queues
+    # behind everything else without a wait limit.
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(path):
+        try:
+            return fetch_upstream(path, prune_entry, PRIORITY_HISTORY, None)[0], None
+        except UpstreamError as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(fetch, path))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def export_rows(year, categories, stages, failures=None):
+    # One row per (bib, stage, waypoint); Classic/M1000 entries get a single row with their ce position.
+    # A stage that can't be fetched gets a single row with an ERROR waypoint (and is added to `failures`)
+    # so the file stays complete and readable after the response has started.
+    jobs = []
+    for category in categories:
+        api_category, cls = resolve_category(category)
+        for stage in stages:
+            jobs.append((category, api_category, cls, str(stage)))
+
+    paths = (f"lastScore-{year}-{api_category}-{stage}" for _, api_category, _, stage in jobs)
+    for (category, _, cls, stage), (doc, error) in zip(jobs, fetch_documents(paths)):
+        if error is not None:
+            print(f"Export of {category} stage {stage} failed: {error}", file=sys.stderr)
+            if failures is not None:
+                failures.append((category, stage))
+            row = dict.fromkeys(EXPORT_COLUMNS)
+            row.update({'year': year, 'category': category, 'class': cls, 'stage': stage,
+                        'waypoint': f"ERROR: {error}"})
+            yield row
+            continue
+        for entry in filter_class(doc, cls):
+            team = entry.get('team') or {}
+            base = {
+                'year': year,
+                'category': category,
+                'class': entry_class(entry),
+                'stage': stage,
+                'bib': team.get('bib'),
+                'driver': driver_name(team),
+                'brand': team.get('brand'),
+                'model': team.get('model'),
+            }
+            if category in CE_RANKING_CATEGORIES:
+                ce = entry.get('ce') or {}
+                yield dict(base, waypoint=None, stage_time=None, overall_time=None,
+                           ce_position=(ce.get('position') or [None])[0])
+                continue
+            cs = entry.get('cs') or {}
+            cg = entry.get('cg') or {}
+            for wp in sorted((wp for wp in set(cs) | set(cg) if is_waypoint(wp)), key=waypoint_order):
+                yield dict(base, waypoint=wp, stage_time=absolute_time(cs.get(wp)),
+                           overall_time=absolute_time(cg.get(wp)), ce_position=None)
+
+
+def iter_csv(rows, chunk_size=64 * 1024):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    # Write-only file object that hands out whatever has been written since the last drain
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_parquet(rows, batch_size=50000):
+    # Requires pyarrow; each batch becomes a row group that is streamed as soon as it is written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('year', pa.string()), ('category', pa.string()), ('class', pa.string()), ('stage', pa.string()),
+        ('bib', pa.int64()), ('driver', pa.string()), ('brand', pa.string()), ('model', pa.string()),
+        ('waypoint', pa.string()), ('stage_time', pa.int64()), ('overall_time', pa.int64()),
+        ('ce_position', pa.int64()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            batch = []
+            yield sink.drain()
+    if batch:
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def export_stream(year, categories, stages, fmt, failures=None):
+    rows = export_rows(year, categories, stages, failures)
+    return iter_parquet(rows) if fmt == 'parquet' else iter_csv(rows)
+
+
+def export_categories(spec):
+    if spec == 'all':
+        return EXPORT_CATEGORIES
+    return [c.strip() for c in spec.split(',') if c.strip()]
+
+
+def run_export(args):
+    if args.format == 'parquet' and not parquet_available():
+        print("Parquet export needs pyarrow: pip install pyarrow", file=sys.stderr)
+        return 1
+    try:
+        stages = parse_stages(args.stages)
+    except ValueError:
+        print("--stages must look like 0-13 or 1,3,5-7", file=sys.stderr)
+        return 2
+
+    failures = []
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in export_stream(args.year, export_categories(args.category), stages, args.format, failures):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    if failures:
+        print(f"Export finished with {len(failures)} failed stage(s), marked ERROR in the output", file=sys.stderr)
+        return 1
+    return 0
+
 
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return render_template_string(HTML_TEMPLATE, flags=FLAGS)
+
+
+@app.route('/wall')
+def wall():
+    return render_template_string(WALL_TEMPLATE)
+
+
+@app.route('/thin')
+def thin():
+    return render_template_string(THIN_TEMPLATE)
 
 
 @app.route('/api/lastScore')
@@ -870,44 +2813,251 @@ def get_last_score():
     category = request.args.get('category', 'M')
     stage = request.args.get('stage', '8')
 
-    url = f"{API_BASE}/lastScore-{year}-{category}-{stage}"
+    try:
+        snap = get_last_score_snapshot(year, category, stage)
+    except UpstreamError as e:
+        return jsonify({"error": str(e)}), 500
+
+    # Serialized once per document version instead of on every poll
+    body = cache.memo(snap, ('json',), lambda: json.dumps(snap.doc, separators=(',', ':')).encode('utf-8'))
+    response = Response(body, mimetype='application/json')
+    response.headers['X-Parse-Ms'] = str(snap.parse.get('parseMs', ''))
+    response.headers['X-Payload-Bytes'] = str(snap.parse.get('bytes', ''))
+    response.headers['X-Read-Buffer-Bytes'] = str(snap.parse.get('bufferBytes', ''))
+    if snap.stale:
+        response.headers['X-Data-Stale'] = '1'
+    return response
+
+
+@app.route('/api/timing')
+def get_timing():
+    year = request.args.get('year', '2026')
+    category = request.args.get('category', 'M')
+    stage = request.args.get('stage', '8')
+
+    try:
+        snap = get_last_score_snapshot(year, category, stage)
+    except UpstreamError as e:
+        return jsonify({"error": str(e)}), 500
+
+    teams_version = team_registry(year, category).update(snap.doc if isinstance(snap.doc, list) else [])
+    entries = cache.memo(snap, ('timing',), lambda: timing_entries(snap))
+    body = b'{"teamsVersion":' + json.dumps(teams_version).encode('utf-8') + b',"entries":' + entries + b'}'
+    response = Response(body, mimetype='application/json')
+    if snap.stale:
+        response.headers['X-Data-Stale'] = '1'
+    return response
+
+
+@app.route('/api/teams')
+def get_teams():
+    year = request.args.get('year', '2026')
+    category = request.args.get('category', 'M')
+    registry = team_registry(year, category)
+
+    if registry.version is None:
+        # Nothing polled yet for this category: build from the latest document
+        try:
+            snap = get_last_score_snapshot(year, category, request.args.get('stage', '0'))
+        except UpstreamError as e:
+            return jsonify({"error": str(e)}), 500
+        registry.update(snap.doc if isinstance(snap.doc, list) else [])
+
+    response = Response(registry.body, mimetype='application/json')
+    response.set_etag(registry.version)
+    if request.args.get('v') == registry.version:
+        # Versioned URL: the content can never change
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+@app.route('/api/fragment')
+def get_fragment():
+    year = request.args.get('year', '2026')
+    category = request.args.get('category', 'A')
+    stage = request.args.get('stage', '8')
+    column = request.args.get('sort', 'classStagePos')
+    requested_cls = request.args.get('class', 'all')
+    if requested_cls not in CATEGORY_CLASSES.get(category, ['all']):
+        return f'<p class="empty">Unknown class: {html.escape(requested_cls)}</p>', 400
+    api_category, cls = resolve_category(category, requested_cls)
 
     try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
+        snap = get_last_score_snapshot(year, api_category, stage)
+    except UpstreamError as e:
+        return f'<p class="empty">Error: {html.escape(str(e))}</p>', 500
+
+    if not is_sort_column(fragment_table(snap, cls), column):
+        # e.g. a bookmarked waypoint column before anyone has reached it
+        column = 'classStagePos'
+    body = fragment_gzip(snap, cls, column)
+    etag = f"{snap.version}-{cls}-{column}"
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        # The encoded bytes differ from the identity ones, so they get their own (strong) ETag
+        response = Response(body, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gz'
+    else:
+        response = Response(gzip.decompress(body), mimetype='text/html')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+@app.route('/api/segments')
+def get_segments():
+    year = request.args.get('year', '2026')
+    category = request.args.get('category', 'M')
+    stage = request.args.get('stage', '8')
+    api_category, cls = resolve_category(category, request.args.get('class', 'all'))
 
-        # Handle empty response (stage not yet available)
-        if not response.text or response.text.strip() == '':
-            return jsonify([])
+    try:
+        snap = get_last_score_snapshot(year, api_category, stage)
+    except UpstreamError as e:
+        return jsonify({"error": str(e)}), 500
 
-        data = response.json()
+    result = cache.memo(snap, ('segments', cls), lambda: compute_segments(filter_class(snap.doc, cls)))
+    return jsonify(dict(result, version=snap.version))
 
-        # Handle various empty data formats
-        if data is None:
-            return jsonify([])
 
-        return jsonify(data)
-    except requests.exceptions.JSONDecodeError:
-        # API returned non-JSON response (likely empty or error page)
-        return jsonify([])
-    except requests.exceptions.RequestException as e:
+@app.route('/api/projections')
+def get_projections():
+    year = request.args.get('year', '2026')
+    category = request.args.get('category', 'M')
+    stage = request.args.get('stage', '8')
+    api_category, cls = resolve_category(category, request.args.get('class', 'all'))
+
+    try:
+        snap = get_last_score_snapshot(year, api_category, stage)
+    except UpstreamError as e:
         return jsonify({"error": str(e)}), 500
 
+    def compute():
+        # Pace ratios come from the whole field, positions only from the class
+        field = filter_class(snap.doc, 'all')
+        waypoints = stage_waypoints(field)
+        pace = cache.memo(snap, ('pace',), lambda: compute_pace_ratios(field, waypoints))
+        return compute_projections(filter_class(snap.doc, cls), pace, waypoints)
+
+    result = cache.memo(snap, ('projections', cls), compute)
+    return jsonify(dict(result, version=snap.version))
+
+
+@app.route('/api/history')
+def get_history():
+    year = request.args.get('year', '2026')
+    stage = request.args.get('stage')
+    bib = request.args.get('bib', type=int)
+    if bib is None:
+        return jsonify({"error": "bib is required"}), 400
+
+    return jsonify({'year': year, 'bib': bib, 'stages': history.query(year, bib, stage)})
+
+
+@app.route('/api/events')
+def get_events():
+    return jsonify(events.since(
+        request.args.get('since', 0, type=int),
+        request.args.get('epoch', type=int),
+        year=request.args.get('year'),
+        category=request.args.get('category'),
+        stage=request.args.get('stage'),
+        type=request.args.get('type'),
+    ))
+
+
+@app.route('/api/export')
+def get_export():
+    year = request.args.get('year', '2026')
+    categories = export_categories(request.args.get('category', 'all'))
+    fmt = request.args.get('format', 'csv')
+
+    try:
+        stages = parse_stages(request.args.get('stages', '0-13'))
+    except ValueError:
+        return jsonify({"error": "stages must look like 0-13 or 1,3,5-7"}), 400
+    if fmt not in ('csv', 'parquet'):
+        return jsonify({"error": "format must be csv or parquet"}), 400
+    if fmt == 'parquet' and not parquet_available():
+        return jsonify({"error": "Parquet export needs pyarrow installed on the server"}), 501
+
+    filename = f"dakar-{year}-{'-'.join(categories)}.{fmt}"
+    mimetype = 'application/vnd.apache.parquet' if fmt == 'parquet' else 'text/csv'
+    return Response(
+        stream_with_context(export_stream(year, categories, stages, fmt)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
+@app.route('/api/wall')
+def get_wall():
+    from concurrent.futures import ThreadPoolExecutor
+
+    year = request.args.get('year', '2026')
+    stage = request.args.get('stage', '8')
+    top = request.args.get('top', WALL_TOP, type=int)
+
+    # Each distinct upstream document is fetched once, all of them concurrently
+    api_categories = sorted({resolve_category(category)[0] for category in WALL_CATEGORIES})
+    with ThreadPoolExecutor(max_workers=len(api_categories)) as pool:
+        futures = {c: pool.submit(get_last_score_snapshot, year, c, stage) for c in api_categories}
+
+    categories = []
+    for category in WALL_CATEGORIES:
+        try:
+            snap = futures[resolve_category(category)[0]].result()
+        except UpstreamError as e:
+            categories.append({'category': category, 'error': str(e)})
+            continue
+        categories.append(wall_category(snap, category, top))
+
+    return jsonify({'year': year, 'stage': stage, 'top': top, 'categories': categories})
+
 
 @app.route('/api/category')
 def get_category():
     year = request.args.get('year', '2026')
-    url = f"{API_BASE}/category-{year}"
-    
+
     try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        return jsonify(response.json())
-    except requests.exceptions.RequestException as e:
+        snap = get_category_snapshot(year)
+    except UpstreamError as e:
         return jsonify({"error": str(e)}), 500
 
+    response = jsonify(snap.doc)
+    if snap.stale:
+        response.headers['X-Data-Stale'] = '1'
+    return response
+
+
+@app.route('/api/cache')
+def get_cache_stats():
+    return jsonify(cache.stats())
+
+
+@app.route('/api/scheduler')
+def get_scheduler_stats():
+    return jsonify(scheduler.stats())
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dakar Rally 2026 Stage Visualizer")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help="run the visualizer (default)")
+    export_parser = commands.add_parser('export', help="export stage results to CSV or Parquet")
+    export_parser.add_argument('--year', default='2026')
+    export_parser.add_argument('--category', default='all', help="e.g. A, M,A or all")
+    export_parser.add_argument('--stages', default='0-13', help="e.g. 0-13 or 1,3,5-7")
+    export_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    export_parser.add_argument('-o', '--output', default='-', help="output file, - for stdout")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        sys.exit(run_export(args))
+
     print("=" * 60)
     print("🏆 Dakar Rally 2026 Stage Visualizer")
     print("   by Spes Systems")
@@ -923,5 +3073,14 @@ if __name__ == '__main__':
     print("Feedback: lukas@spes.systems")
     print("Press Ctrl+C to stop")
     print("=" * 60)
-    
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+
+    # With debug the reloader runs this block twice: in the watcher parent and in the serving child
+    debug = True
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_history()
+        restored = start_warm_start()
+        if restored:
+            print(f"Restored {len(restored)} documents from {SNAPSHOT_PATH} (stale until refreshed)")
+        # Let SIGTERM run the atexit savers too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.run(host='0.0.0.0', port=5001, debug=debug)
\ No newline at end of file